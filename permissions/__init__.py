@@ -23,4 +23,5 @@ SOFTWARE.
 """
 
 from .flags import *
-from .permissions import *
\ No newline at end of file
+from .permissions import *
+from .writer import *
\ No newline at end of file
@@ -0,0 +1,457 @@
+"""
+MIT License
+
+Copyright (c) 2022-present Baptiste#4040 (Discord)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from __future__ import annotations
+
+import abc
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+import weakref
+from typing import ClassVar, Dict, List, Optional, Tuple, Union
+
+from .permissions import Permissions
+
+__all__ = (
+    'PermissionUpdate',
+    'PermissionBackend',
+    'SQLitePermissionBackend',
+    'PermissionWriter',
+)
+
+_log = logging.getLogger(__name__)
+
+Entity = Union[int, str]
+
+
+class PermissionUpdate:
+    """A pending mutation of an entity's permission value.
+
+    An update is either absolute (``value`` is set, the stored value is
+    replaced) or relative (``value`` is ``None``, the stored value goes
+    through :meth:`Permissions.handle_overwrite` with ``allow`` and ``deny``).
+
+    Attributes
+    -----------
+    value: Optional[:class:`int`]
+        The new raw permission value, or ``None`` for a relative update.
+    allow: :class:`int`
+        The bits to set on the stored value.
+    deny: :class:`int`
+        The bits to clear on the stored value.
+    """
+
+    __slots__ = ('value', 'allow', 'deny')
+
+    def __init__(self, value: Optional[int] = None, allow: int = 0, deny: int = 0):
+        self.value = value
+        self.allow = allow
+        self.deny = deny
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} value={self.value} allow={self.allow} deny={self.deny}>'
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, PermissionUpdate)
+            and self.value == other.value
+            and self.allow == other.allow
+            and self.deny == other.deny
+        )
+
+    @property
+    def is_absolute(self) -> bool:
+        """:class:`bool`: Returns ``True`` if the update replaces the stored value."""
+        return self.value is not None
+
+    def apply(self, base: int) -> int:
+        """Returns the value obtained by applying this update on ``base``."""
+        if self.value is not None:
+            return self.value
+        return (base & ~self.deny) | self.allow
+
+    def merge(self, other: PermissionUpdate) -> PermissionUpdate:
+        """Returns a single update equivalent to applying self, then other."""
+        if other.value is not None:
+            return PermissionUpdate(other.value)
+        if self.value is not None:
+            return PermissionUpdate(other.apply(self.value))
+        # ((base & ~d1) | a1) & ~d2 | a2
+        # == (base & ~(d1 | d2)) | ((a1 & ~d2) | a2)
+        return PermissionUpdate(
+            allow=(self.allow & ~other.deny) | other.allow,
+            deny=self.deny | other.deny,
+        )
+
+
+class PermissionBackend(abc.ABC):
+    """The base class of the storages a :class:`PermissionWriter` flushes to.
+
+    Subclasses must implement :meth:`write_batch`.
+    """
+
+    @abc.abstractmethod
+    def write_batch(self, updates: List[Tuple[Entity, PermissionUpdate]]) -> None:
+        """Persists the given updates in a single transaction.
+
+        The updates must be applied in the given order, and either all of them
+        are persisted or none of them is: on failure, this method must roll back
+        and raise.
+
+        Parameters
+        ------------
+        updates: List[Tuple[Union[:class:`int`, :class:`str`], :class:`PermissionUpdate`]]
+            The ``(entity, update)`` pairs to persist. An entity appears at most once.
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Releases the resources held by the backend."""
+        pass
+
+
+class SQLitePermissionBackend(PermissionBackend):
+    """A :class:`PermissionBackend` storing permission values in a SQLite table.
+
+    It is mainly intended as a stand-in for the real database in tests.
+
+    Parameters
+    ------------
+    database: :class:`str`
+        The path of the SQLite database. Defaults to an in-memory database.
+    table: :class:`str`
+        The name of the table holding the ``(entity, value)`` rows.
+    """
+
+    def __init__(self, database: str = ':memory:', table: str = 'permissions'):
+        if not table.isidentifier():
+            raise ValueError(f'{table!r} is not a valid table name.')
+        self.table = table
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        # The connection is shared with the writer's timer thread,
+        # reads must not see a batch that is not committed yet.
+        self._lock = threading.Lock()
+        with self.connection:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} (entity PRIMARY KEY, value INTEGER NOT NULL)'
+            )
+
+    def write_batch(self, updates: List[Tuple[Entity, PermissionUpdate]]) -> None:
+        # The connection context manager commits the whole batch at once,
+        # or rolls it back if any statement fails.
+        with self._lock, self.connection:
+            for entity, update in updates:
+                if update.value is not None:
+                    self.connection.execute(
+                        f'INSERT INTO {self.table} (entity, value) VALUES (?, ?) '
+                        f'ON CONFLICT(entity) DO UPDATE SET value = excluded.value',
+                        (entity, update.value),
+                    )
+                else:
+                    self.connection.execute(
+                        f'INSERT INTO {self.table} (entity, value) VALUES (?, ?) '
+                        f'ON CONFLICT(entity) DO UPDATE SET value = (value & ~?) | ?',
+                        (entity, update.allow, update.deny, update.allow),
+                    )
+
+    def get(self, entity: Entity) -> Optional[Permissions]:
+        """Returns the stored :class:`Permissions` of ``entity``, or ``None`` if there is none."""
+        with self._lock:
+            row = self.connection.execute(
+                f'SELECT value FROM {self.table} WHERE entity = ?', (entity,)
+            ).fetchone()
+        if row is None:
+            return None
+        return Permissions(row[0])
+
+    def close(self) -> None:
+        with self._lock:
+            self.connection.close()
+
+
+class PermissionWriter:
+    """A write-behind buffer for permission updates.
+
+    Updates are kept in memory and coalesced per entity, so that several
+    changes to the same entity end up as a single write. They are sent
+    to the backend when ``max_batch`` entities are pending, when
+    ``flush_interval`` seconds have passed since the first pending update,
+    or when :meth:`flush` is called. A flush writes the buffer in batches
+    of at most ``max_batch`` entities, each in its own transaction.
+    Automatic flushes run on a background thread and their errors are
+    logged.
+
+    Batches reach the backend in order, and entities are ordered by their
+    latest update. If a batch fails, it is put back along with the batches
+    after it, in front of the updates received in the meantime, so nothing
+    is lost and nothing is reordered. The failed updates are retried after
+    ``retry_delay`` seconds, doubled on each consecutive failure; until
+    then, a full buffer does not trigger any flush. The buffer itself is
+    not bounded, so it keeps growing while the backend is down.
+
+    After a crash, the backend holds exactly the batches it committed, in
+    order; updates still in memory are lost. Writers that were not closed
+    are flushed at interpreter exit, but not if the process is killed.
+    Replaying a batch whose commit status is unknown is safe: absolute
+    updates are idempotent, and so are relative ones, since applying the
+    same allow and deny twice gives the same value as applying them once.
+
+    The writer can be used as a context manager, in which case it is
+    closed (and therefore flushed) on exit.
+
+    Parameters
+    ------------
+    backend: :class:`PermissionBackend`
+        The storage the updates are flushed to.
+    max_batch: :class:`int`
+        The number of pending entities triggering a flush, and the
+        maximum number of entities written in a single transaction.
+    flush_interval: Optional[:class:`float`]
+        The number of seconds after which pending updates are flushed.
+        ``None`` disables the time trigger.
+    retry_delay: :class:`float`
+        The number of seconds before retrying a failed batch.
+    """
+
+    # Failed flushes are retried after retry_delay * 2 ** n seconds, n capped here.
+    MAX_BACKOFF_EXPONENT: ClassVar[int] = 6
+
+    def __init__(
+        self,
+        backend: PermissionBackend,
+        *,
+        max_batch: int = 100,
+        flush_interval: Optional[float] = 5.0,
+        retry_delay: float = 5.0,
+    ):
+        if max_batch < 1:
+            raise ValueError('max_batch must be at least 1.')
+        if flush_interval is not None and flush_interval <= 0:
+            raise ValueError('flush_interval must be positive.')
+        if retry_delay <= 0:
+            raise ValueError('retry_delay must be positive.')
+
+        self.backend = backend
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self._pending: Dict[Entity, PermissionUpdate] = {}
+        self._lock = threading.Lock()
+        # Held for the whole backend call so batches can't overtake each other.
+        self._flush_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._timer_due = 0.0
+        self._failures = 0
+        self._closed = False
+        _writers.add(self)
+
+    def __enter__(self) -> PermissionWriter:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def pending(self) -> Dict[Entity, PermissionUpdate]:
+        """Dict[Union[:class:`int`, :class:`str`], :class:`PermissionUpdate`]: A copy of the updates waiting to be flushed."""
+        with self._lock:
+            return dict(self._pending)
+
+    def set(self, entity: Entity, permissions: Union[Permissions, int]) -> None:
+        """Replaces the permission value of ``entity``.
+
+        The update is only buffered: this method does not wait for
+        the backend, and backend errors are never raised here.
+
+        Parameters
+        ------------
+        entity: Union[:class:`int`, :class:`str`]
+            The key of the entity (e.g. a role ID).
+        permissions: Union[:class:`Permissions`, :class:`int`]
+            The new permissions of the entity.
+        """
+        if isinstance(permissions, Permissions):
+            permissions = permissions.value
+        elif not isinstance(permissions, int):
+            raise TypeError(f'Expected Permissions or int, received {permissions.__class__.__name__} instead.')
+        self._add(entity, PermissionUpdate(permissions))
+
+    def overwrite(
+        self,
+        entity: Entity,
+        allow: Union[Permissions, int] = 0,
+        deny: Union[Permissions, int] = 0,
+    ) -> None:
+        """Allows and denies permissions of ``entity``, like :meth:`Permissions.handle_overwrite`.
+
+        The update is only buffered: this method does not wait for
+        the backend, and backend errors are never raised here.
+
+        Parameters
+        ------------
+        entity: Union[:class:`int`, :class:`str`]
+            The key of the entity (e.g. a role ID).
+        allow: Union[:class:`Permissions`, :class:`int`]
+            The permissions to grant.
+        deny: Union[:class:`Permissions`, :class:`int`]
+            The permissions to remove. ``allow`` takes precedence.
+        """
+        if isinstance(allow, Permissions):
+            allow = allow.value
+        if isinstance(deny, Permissions):
+            deny = deny.value
+        if not isinstance(allow, int) or not isinstance(deny, int):
+            raise TypeError('allow and deny must be Permissions or int.')
+        self._add(entity, PermissionUpdate(allow=allow, deny=deny))
+
+    def _add(self, entity: Entity, update: PermissionUpdate) -> None:
+        if not isinstance(entity, (int, str)) or isinstance(entity, bool):
+            raise TypeError(f'Expected int or str entity, received {entity.__class__.__name__} instead.')
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Cannot write to a closed PermissionWriter.')
+            previous = self._pending.pop(entity, None)
+            if previous is not None:
+                update = previous.merge(update)
+            # Re-inserting moves the entity to the end, so the batch order
+            # follows the latest update of each entity.
+            self._pending[entity] = update
+            if self._failures:
+                # The backend is failing, wait for the scheduled retry.
+                pass
+            elif len(self._pending) >= self.max_batch:
+                self._schedule(0)
+            elif self.flush_interval is not None:
+                self._schedule(self.flush_interval)
+
+    def _schedule(self, delay: float) -> None:
+        # Must be called with self._lock held.
+        if self._closed:
+            return
+        due = time.monotonic() + delay
+        if self._timer is not None:
+            if self._timer_due <= due:
+                return
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._flush, kwargs={'log_errors': True})
+        self._timer.daemon = True
+        self._timer_due = due
+        self._timer.start()
+
+    def flush(self) -> int:
+        """Sends every pending update to the backend.
+
+        The updates are written in batches of at most ``max_batch`` entities.
+        If the backend raises, the failed batch and the following ones are
+        kept for the next flush and the exception is propagated.
+
+        Returns
+        --------
+        :class:`int`
+            The number of entities written.
+        """
+        return self._flush(log_errors=False)
+
+    def _flush(self, *, log_errors: bool) -> int:
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                updates = list(self._pending.items())
+                self._pending.clear()
+
+            written = 0
+            while written < len(updates):
+                batch = updates[written:written + self.max_batch]
+                try:
+                    self.backend.write_batch(batch)
+                except BaseException as exc:
+                    failed = updates[written:]
+                    delay = self._restore(failed)
+                    if log_errors and isinstance(exc, Exception):
+                        _log.exception(
+                            'Failed to flush %s permission updates, retrying in %s seconds.',
+                            len(failed), delay,
+                        )
+                        return written
+                    raise
+                written += len(batch)
+                with self._lock:
+                    self._failures = 0
+
+            return written
+
+    def _restore(self, failed: List[Tuple[Entity, PermissionUpdate]]) -> float:
+        # Puts failed updates back in front of the newer ones and schedules
+        # the retry. Returns the retry delay.
+        with self._lock:
+            newer = self._pending
+            self._pending = {}
+            for entity, update in failed:
+                later = newer.pop(entity, None)
+                self._pending[entity] = update if later is None else update.merge(later)
+            self._pending.update(newer)
+
+            self._failures += 1
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            exponent = min(self._failures - 1, self.MAX_BACKOFF_EXPONENT)
+            delay = self.retry_delay * 2 ** exponent
+            self._schedule(delay)
+            return delay
+
+    def close(self) -> None:
+        """Flushes the pending updates and stops accepting new ones.
+
+        The backend is not closed.
+        """
+        _writers.discard(self)
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.flush()
+
+
+# Writers still open at interpreter exit, held weakly so that
+# an unclosed writer can still be garbage collected.
+_writers: weakref.WeakSet[PermissionWriter] = weakref.WeakSet()
+
+
+@atexit.register
+def _close_writers() -> None:
+    for writer in list(_writers):
+        try:
+            writer.close()
+        except Exception:
+            _log.exception('Failed to flush %s permission updates at exit.', len(writer))
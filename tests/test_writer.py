@@ -0,0 +1,225 @@
+import gc
+import itertools
+import threading
+import time
+import weakref
+
+import pytest
+
+from permissions import Permissions, PermissionBackend, PermissionUpdate, PermissionWriter, SQLitePermissionBackend
+
+
+class FailingBackend(PermissionBackend):
+    def __init__(self):
+        self.fail = True
+        self.calls = 0
+        self.batches = []
+        self.attempted = threading.Event()
+
+    def write_batch(self, updates):
+        self.calls += 1
+        self.attempted.set()
+        if self.fail:
+            raise OSError('backend down')
+        self.batches.append(list(updates))
+
+
+class RecordingBackend(PermissionBackend):
+    def __init__(self):
+        self.batches = []
+        self.written = threading.Event()
+
+    def write_batch(self, updates):
+        self.batches.append(list(updates))
+        self.written.set()
+
+
+UPDATES = [
+    PermissionUpdate(0b1010),
+    PermissionUpdate(allow=0b0101),
+    PermissionUpdate(deny=0b1100),
+    PermissionUpdate(allow=0b0011, deny=0b0110),
+    PermissionUpdate(0),
+]
+
+
+@pytest.mark.parametrize('first,second', list(itertools.product(UPDATES, repeat=2)))
+def test_merge_matches_sequential_apply(first, second):
+    merged = first.merge(second)
+    for base in range(16):
+        assert merged.apply(base) == second.apply(first.apply(base))
+
+
+def test_sqlite_absolute_and_relative_updates():
+    backend = SQLitePermissionBackend()
+    backend.write_batch([
+        ('role', PermissionUpdate(Permissions.general().value)),
+        (1, PermissionUpdate(allow=0b0110, deny=0b0001)),
+    ])
+    assert backend.get('role') == Permissions.general()
+    # A relative update on a missing row starts from no permissions.
+    assert backend.get(1) == Permissions(0b0110)
+
+    backend.write_batch([
+        ('role', PermissionUpdate(allow=1 << 23, deny=1 << 0)),
+        (1, PermissionUpdate(0b1000)),
+    ])
+    expected = Permissions.general()
+    expected.handle_overwrite(1 << 23, 1 << 0)
+    assert backend.get('role') == expected
+    assert backend.get(1) == Permissions(0b1000)
+    assert backend.get('missing') is None
+
+
+def entities(batch):
+    return [entity for entity, _ in batch]
+
+
+def test_entity_type_is_checked():
+    with PermissionWriter(RecordingBackend(), flush_interval=None) as writer:
+        with pytest.raises(TypeError):
+            writer.set((1, 2), 3)
+        assert len(writer) == 0
+
+
+def test_backend_must_implement_write_batch():
+    with pytest.raises(TypeError):
+        PermissionBackend()
+
+
+def test_failed_batch_is_restored_ahead_of_newer_updates():
+    backend = FailingBackend()
+    with PermissionWriter(backend, flush_interval=None, retry_delay=60) as writer:
+
+        def write_batch(updates):
+            # Updates received while the batch is being written.
+            writer.set('c', 0b0100)
+            writer.overwrite('a', allow=0b1000)
+            raise OSError('backend down')
+
+        backend.write_batch = write_batch
+        writer.set('a', 0b0001)
+        writer.set('b', 0b0010)
+        with pytest.raises(OSError):
+            writer.flush()
+
+        assert list(writer.pending) == ['a', 'b', 'c']
+        assert writer.pending['a'] == PermissionUpdate(0b1001)
+
+        del backend.write_batch
+        backend.fail = False
+        assert writer.flush() == 3
+        assert entities(backend.batches[0]) == ['a', 'b', 'c']
+
+
+def test_failed_flush_is_retried_by_timer():
+    backend = FailingBackend()
+    with PermissionWriter(backend, flush_interval=None, retry_delay=0.05) as writer:
+        writer.set('a', 1)
+        with pytest.raises(OSError):
+            writer.flush()
+
+        backend.fail = False
+        deadline = time.monotonic() + 2
+        while len(writer) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(writer) == 0
+        assert backend.batches == [[('a', PermissionUpdate(1))]]
+
+
+def test_flush_is_split_in_batches():
+    backend = FailingBackend()
+    with PermissionWriter(backend, max_batch=2, flush_interval=None, retry_delay=60) as writer:
+        for entity in range(6):
+            writer.set(entity, 1)
+        assert backend.attempted.wait(2)
+
+        backend.fail = False
+        writer.flush()
+        assert [entities(batch) for batch in backend.batches] == [[0, 1], [2, 3], [4, 5]]
+
+
+def test_only_failed_batches_are_restored():
+    backend = RecordingBackend()
+    with PermissionWriter(backend, max_batch=2, flush_interval=None, retry_delay=60) as writer:
+        for entity in range(5):
+            writer._pending[entity] = PermissionUpdate(1)
+
+        write_batch = backend.write_batch
+
+        def fail_second(updates):
+            if len(backend.batches) == 1:
+                raise OSError('backend down')
+            write_batch(updates)
+
+        backend.write_batch = fail_second
+        with pytest.raises(OSError):
+            writer.flush()
+        assert list(writer.pending) == [2, 3, 4]
+
+        backend.write_batch = write_batch
+        assert writer.flush() == 3
+        assert [entities(batch) for batch in backend.batches] == [[0, 1], [2, 3], [4]]
+
+
+def test_size_trigger_flushes_in_background():
+    backend = RecordingBackend()
+    with PermissionWriter(backend, max_batch=3, flush_interval=None) as writer:
+        writer.set(1, 1)
+        writer.set(1, 2)
+        writer.set(2, 1)
+        assert not backend.batches
+        writer.set(3, 1)
+        assert backend.written.wait(2)
+        assert entities(backend.batches[0]) == [1, 2, 3]
+
+
+def test_size_trigger_does_not_raise_backend_errors():
+    backend = FailingBackend()
+    with PermissionWriter(backend, max_batch=2, flush_interval=None, retry_delay=60) as writer:
+        writer.set(1, 1)
+        writer.set(2, 1)
+        assert backend.attempted.wait(2)
+        deadline = time.monotonic() + 2
+        while not writer._failures and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert set(writer.pending) == {1, 2}
+        backend.fail = False
+    assert not writer.pending
+
+
+def test_failing_backend_is_not_retried_on_every_update():
+    backend = FailingBackend()
+    with PermissionWriter(backend, max_batch=10, flush_interval=None, retry_delay=60) as writer:
+        for entity in range(2000):
+            writer.set(entity, 1)
+        time.sleep(0.1)
+        assert backend.calls <= 3
+        assert len(writer) == 2000
+        backend.fail = False
+    assert len(backend.batches) == 200
+
+
+def test_time_trigger():
+    backend = RecordingBackend()
+    with PermissionWriter(backend, flush_interval=0.05) as writer:
+        writer.overwrite('role', allow=0b11)
+        assert backend.written.wait(2)
+        assert backend.batches == [[('role', PermissionUpdate(allow=0b11))]]
+
+
+def test_unclosed_writer_is_collected():
+    writer = PermissionWriter(RecordingBackend(), flush_interval=None)
+    ref = weakref.ref(writer)
+    del writer
+    gc.collect()
+    assert ref() is None
+
+
+def test_close_flushes_and_rejects_writes():
+    backend = SQLitePermissionBackend()
+    with PermissionWriter(backend, flush_interval=None) as writer:
+        writer.set('role', Permissions.roleplay_configuration())
+    assert backend.get('role') == Permissions.roleplay_configuration()
+    with pytest.raises(RuntimeError):
+        writer.set('role', 0)